@@ -1,33 +1,48 @@
 #!/usr/bin/python
 
 from __future__ import annotations
-from typing import Callable, Dict, List, Tuple
-from beeprint import pp
+from typing import Dict, List, Tuple
+import os
 import unittest
 
 
-class Ty:
-    def __init__(self, ty: str) -> None:
-        self.ty = ty
+INT_MASK = 0b01
+FLOAT_MASK = 0b10
+
+_MASK = {"i32": INT_MASK, "i64": INT_MASK, "f32": FLOAT_MASK, "f64": FLOAT_MASK}
 
-    def is_int(self) -> Tuple[bool, str]:
-        match self.ty:
-            case "i32" | "i64": return True, "int"
-            case _: return False, "int"
 
-    def is_float(self) -> Tuple[bool, str]:
-        match self.ty:
-            case "f32" | "f64": return True, "float"
-            case _: return False, "float"
+class Ty:
+    # ground types are interned, `Ty(name)` always returns the same instance
+    # for a name so equality is identity
+    __slots__ = ('ty', 'mask', '_repr', )
+
+    def __new__(cls, ty: str) -> Ty:
+        self = _TYS.get(ty)
+        if self is None:
+            self = super().__new__(cls)
+            self.ty = ty
+            # unknown names get no mask and fail the int/float checks
+            self.mask = _MASK.get(ty, 0)
+            self._repr = f"\033[1;32m{ty}\033[0m"
+            _TYS[ty] = self
+        return self
 
     def __repr__(self) -> str:
-        return f"\033[1;32m{self.ty}\033[0m"
+        return self._repr
+
+
+_TYS: Dict[str, Ty] = {}
 
-    def __eq__(self, o: Ty) -> bool:
-        return o.ty == self.ty
+
+TY_INT = 0
+TY_FLOAT = 1
+TY_NORMAL = 2
 
 
 class T:
+    __slots__ = ('node_id', )
+    kind: int
     __match_args__ = ('node_id', )
 
     def __init__(self, node_id: int) -> None:
@@ -37,28 +52,24 @@ class T:
         return self.node_id == o.node_id
 
 
-class Int(T):
-    __match_args__ = ('node_id', )
+class Unresolved(T):
+    # an integer or float literal type (`kind` is TY_INT or TY_FLOAT) that
+    # has not been unified with a concrete type yet
+    __slots__ = ('kind', )
+    __match_args__ = ('node_id', 'kind', )
 
-    def __init__(self, node_id: int) -> None:
+    def __init__(self, node_id: int, kind: int) -> None:
         super().__init__(node_id)
+        self.kind = kind
 
     def __repr__(self) -> str:
-        return f"int_{self.node_id}"
-
-
-class Float(T):
-    __match_args__ = ('node_id', )
-
-    def __init__(self, node_id: int) -> None:
-        super().__init__(node_id)
-
-    def __repr__(self) -> str:
-        return f"float_{self.node_id}"
+        return f"{'int' if self.kind == TY_INT else 'float'}_{self.node_id}"
 
 
 class Normal(T):
+    __slots__ = ('ty', )
     __match_args__ = ('ty', )
+    kind = TY_NORMAL
 
     def __init__(self, ty: Ty) -> None:
         super().__init__(-1)
@@ -70,38 +81,37 @@ class Normal(T):
 ######################################################
 
 
-node_id = 0
-
-
-def gen_node_id() -> int:
-    global node_id
-    node_id += 1
-    return node_id
-
-
 class Stmt:
-    pass
+    __slots__ = ()
 
 
 class Expr(Stmt):
+    __slots__ = ('node_id', 'ty', )
+
     def __init__(self) -> None:
-        self.node_id = gen_node_id()
+        # assigned by `number_nodes` before inference
+        self.node_id = -1
         self.ty: Ty | None = None
 
 
 class IntLit(Expr):
+    __slots__ = ('value', )
+
     def __init__(self, value: int):
         super().__init__()
         self.value = value
 
 
 class FloatLit(Expr):
+    __slots__ = ('value', )
+
     def __init__(self, value: float):
         super().__init__()
         self.value = value
 
 
 class Ident(Expr):
+    __slots__ = ('name', )
     __match_args__ = ('name', )
 
     def __init__(self, name: str):
@@ -110,6 +120,7 @@ class Ident(Expr):
 
 
 class Binary(Expr):
+    __slots__ = ('left', 'right', )
     __match_args__ = ('left', 'right', )
 
     def __init__(self, left: Expr, right: Expr) -> None:
@@ -119,6 +130,7 @@ class Binary(Expr):
 
 
 class Binding(Stmt):
+    __slots__ = ('name', 'ty', 'init', )
     __match_args__ = ('name', 'ty', 'init')
 
     def __init__(self, name: str, ty: Ty | None, init: Expr) -> None:
@@ -128,6 +140,7 @@ class Binding(Stmt):
 
 
 class Fn:
+    __slots__ = ('name', 'ret_ty', 'stmts', 'last_expr', )
     __match_args__ = ('name', 'ret_ty', 'stmts', 'last_expr')
 
     def __init__(self, name: str, ret_ty: Ty, stmts: List[Stmt], last_expr: Expr | None):
@@ -138,27 +151,120 @@ class Fn:
 
 
 class Env:
+    __slots__ = ('parent', 'bindings', 'exprs', 'parent_id', 'rank', 'unres_class', 'resolved', 'constraints', )
+
     def __init__(self, parent: Env | None = None) -> None:
         self.parent = parent
-        self.bindings: Dict[str, T] = {}
-        self.binding_id: Dict[int, str] = {}
-        self.unresolved: Dict[int, T] = {}
-        self.exprs: Dict[int, Expr] = {}
-        self.paren_exprs: Dict[int, int] = {}
+        # scopes start from a flat copy of the parent's bindings so lookups
+        # never have to walk the parent chain. The copy is a snapshot:
+        # bindings added to the parent after the child is created are not
+        # visible in the child
+        self.bindings: Dict[str, T] = dict(parent.bindings) if parent else {}
+        # per-node tables indexed by node_id, set up by `reset`
+        self.exprs: List[Expr] = []
+        self.parent_id: List[int] = []
+        self.rank: List[int] = []
+        # node_ids still waiting for a type, keyed by class representative
+        self.unres_class: List[List[int] | None] = []
+        self.resolved: List[Ty | None] = []
+        # (node_id, expected) pairs recorded by `unify`, applied by `solve`
+        self.constraints: List[Tuple[int, Ty]] = []
 
     def add_binding(self, name: str, ty: T):
         self.bindings[name] = ty
 
     def find_ty(self, name: str) -> T | None:
-        if name in self.bindings:
-            return self.bindings[name]
-
-    def pop_unres(self, id: int):
-        if id in self.unresolved:
-            self.unresolved.pop(id)
+        return self.bindings.get(name)
+
+    def reset(self, exprs: List[Expr]):
+        # node_ids restart at 0 for every function, so each one starts from
+        # fresh tables
+        n = len(exprs)
+        self.exprs = exprs
+        self.parent_id = list(range(n))
+        self.rank = [0] * n
+        self.unres_class = [None] * n
+        self.resolved = [None] * n
+        self.constraints = []
+
+    def seal_bindings(self):
+        # bindings outlive the node tables of the function that made them:
+        # keep resolved ones as concrete types and detach the unresolved
+        # ones from their class (node_id -1) so the next function that
+        # references them seeds a fresh class
+        for name, ty in list(self.bindings.items()):
+            if ty.kind == TY_NORMAL or ty.node_id < 0:
+                continue
+            t = self.resolved[self.find(ty.node_id)]
+            if t is None:
+                self.bindings[name] = Unresolved(-1, ty.kind)
+            else:
+                self.bindings[name] = Normal(t)
+
+    def make_class(self, id: int):
+        self.parent_id[id] = id
+        self.rank[id] = 0
+        self.unres_class[id] = []
+
+    def find(self, id: int) -> int:
+        parent_id = self.parent_id
+        while parent_id[id] != id:
+            parent_id[id] = parent_id[parent_id[id]]
+            id = parent_id[id]
+        return id
+
+    def union(self, a: int, b: int) -> int:
+        ra, rb = self.find(a), self.find(b)
+        if ra == rb:
+            return ra
+        if self.rank[ra] < self.rank[rb]:
+            ra, rb = rb, ra
+        elif self.rank[ra] == self.rank[rb]:
+            self.rank[ra] += 1
+        self.parent_id[rb] = ra
+        # append the shorter member list onto the longer one
+        ua, ub = self.unres_class[ra], self.unres_class[rb]
+        if len(ua) < len(ub):
+            ua, ub = ub, ua
+            self.unres_class[ra] = ua
+        ua.extend(ub)
+        self.unres_class[rb] = None
+        return ra
+
+    def solve(self):
+        exprs, resolved = self.exprs, self.resolved
+        for id, expected in self.constraints:
+            rep = self.find(id)
+            t = resolved[rep]
+            if t is not None:
+                assert t is expected, f"type-error: expected `{expected}` but got `{t}`"
+                continue
+            resolved[rep] = expected
+            for i in self.unres_class[rep]:
+                exprs[i].ty = expected
+            self.unres_class[rep] = None
+        self.constraints.clear()
+
+
+def number_nodes(fn: Fn) -> List[Expr]:
+    # stamp dense node_ids in breadth-first order, returns the nodes indexed
+    # by node_id
+    queue: List[Expr] = [stmt.init for stmt in fn.stmts if isinstance(stmt, Binding)]
+    if fn.last_expr:
+        queue.append(fn.last_expr)
+    i = 0
+    while i < len(queue):
+        expr = queue[i]
+        expr.node_id = i
+        if type(expr) is Binary:
+            queue.append(expr.left)
+            queue.append(expr.right)
+        i += 1
+    return queue
 
 
 def infer_types(fn: Fn, env: Env):
+    env.reset(number_nodes(fn))
     for stmt in fn.stmts:
         match stmt:
             case Binding(name, ty, init):
@@ -171,106 +277,153 @@ def infer_types(fn: Fn, env: Env):
     if fn.last_expr:
         ty = infer(env, fn.last_expr)
         unify(env, ty, fn.ret_ty)
+    env.solve()
+    env.seal_bindings()
 
 
 def infer(env: Env, expr: Expr) -> T:
-    env.exprs[expr.node_id] = expr
-    ty: T | None = None
-    match expr:
-        case IntLit():
-            ty = Int(expr.node_id)
-        case FloatLit():
-            ty = Float(expr.node_id)
-        case Ident(name):
-            env.binding_id[expr.node_id] = name
-            ty = env.find_ty(name)
-            if not ty:
-                assert False, f"`{name}` not found in this scope"
-        case Binary(left, right):
-            env.paren_exprs[left.node_id] = expr.node_id
-            env.paren_exprs[right.node_id] = expr.node_id
-            t1 = infer(env, left)
-            t2 = infer(env, right)
-            if t1 != t2:
-                match t1, t2:
-                    case Normal(t01), Normal(t02):
-                        assert t01 == t02, f"type-error: binary op `{t01}` and `{t02}`"
-                        ty = t1
-                    case Int(t01), Int(t02):
-                        ty = Int(expr.node_id)
-                    case Float(t01), Float(t02):
-                        ty = Float(expr.node_id)
-                    case(Normal(t01), (Int(_) | Float(_)) as e) | ((Int(_) | Float(_)) as e, Normal(t01)):
-                        unify(env, e, t01)
-                        ty = t1
-                    case a, b:
-                        assert False, f"{a}, {b}"
-            else:
-                ty = t1
-        case _:
-            assert False
-    assert ty
-    match ty:
-        case Int() | Float():
-            env.unresolved[expr.node_id] = ty
-        case Normal(t):
-            expr.ty = t
+    assert expr.node_id >= 0, "nodes are numbered by `infer_types`"
+    # post-order walk with an explicit stack: phase 0 visits a node, phase 1
+    # combines the already inferred operands of a `Binary`
+    work: List[Tuple[int, Expr]] = [(0, expr)]
+    results: List[T] = []
+    push, pop = work.append, work.pop
+    push_result, pop_result = results.append, results.pop
+    unres_class = env.unres_class
+    find = env.find
+    while work:
+        phase, expr = pop()
+        if phase == 0:
+            if type(expr) is Binary:
+                push((1, expr))
+                push((0, expr.right))
+                push((0, expr.left))
+                continue
+            ty = EXPR_DISPATCH[type(expr)](env, expr)
+        else:
+            t2 = pop_result()
+            t1 = pop_result()
+            ty = _infer_binary(env, t1, t2)
+        if ty.kind == TY_NORMAL:
+            expr.ty = ty.ty
+        else:
+            unres_class[find(ty.node_id)].append(expr.node_id)
+        push_result(ty)
+    return pop_result()
+
+
+def _infer_int_lit(env: Env, expr: IntLit) -> T:
+    env.make_class(expr.node_id)
+    return Unresolved(expr.node_id, TY_INT)
+
+
+def _infer_float_lit(env: Env, expr: FloatLit) -> T:
+    env.make_class(expr.node_id)
+    return Unresolved(expr.node_id, TY_FLOAT)
+
+
+def _infer_ident(env: Env, expr: Ident) -> T:
+    ty = env.find_ty(expr.name)
+    if not ty:
+        assert False, f"`{expr.name}` not found in this scope"
+    if ty.node_id < 0 and ty.kind != TY_NORMAL:
+        # unresolved binding carried over from an earlier function
+        env.make_class(expr.node_id)
+        ty = Unresolved(expr.node_id, ty.kind)
+        env.add_binding(expr.name, ty)
     return ty
 
 
-def set_type(env: Env, expr: Expr, ty: Ty):
-    expr.ty = ty
-    env.pop_unres(expr.node_id)
-    match expr:
-        case Binary(left, right):
-            set_type(env, left, ty)
-            set_type(env, right, ty)
-        case Ident(name):
-            unify(env, env.bindings[name], ty)
-            env.bindings[name] = Normal(ty)
+def _infer_binary(env: Env, t1: T, t2: T) -> T:
+    if t1 is t2:
+        return t1
+    k1, k2 = t1.kind, t2.kind
+    if k1 == TY_NORMAL and k2 == TY_NORMAL:
+        t01, t02 = t1.ty, t2.ty
+        assert t01 is t02, f"type-error: binary op `{t01}` and `{t02}`"
+    elif k1 == k2:
+        env.union(t1.node_id, t2.node_id)
+    elif k1 == TY_NORMAL:
+        unify(env, t2, t1.ty)
+    elif k2 == TY_NORMAL:
+        unify(env, t1, t2.ty)
+    else:
+        assert False, f"{t1}, {t2}"
+    return t1
+
+
+# leaf expression handlers, `Binary` is handled by `infer` itself
+EXPR_DISPATCH = {
+    IntLit: _infer_int_lit,
+    FloatLit: _infer_float_lit,
+    Ident: _infer_ident,
+}
 
 
 def unify(env: Env, ty: T, expected: Ty):
-    def f(is_expected_type: Callable):
-        is_ty = is_expected_type(expected)
-        if is_ty[0]:
-            for i, t in list(env.unresolved.items()):
-                if t != ty:
-                    continue
-                iexpr = env.exprs[i]
-                set_type(env, iexpr, expected)
-                if i in env.paren_exprs:
-                    p_id = env.paren_exprs[i]
-                    pexpr = env.exprs[p_id]
-                    set_type(env, pexpr, expected)
-                if i in env.binding_id:
-                    env.bindings[env.binding_id[i]] = Normal(expected)
-                    env.binding_id.pop(i)
-        else:
-            assert False, f"type-error: expected `{expected}` but got `{is_ty[1]}`"
-
-    match ty:
-        case Int(_):
-            f(Ty.is_int)
-        case Float(_):
-            f(Ty.is_float)
-        case Normal(t):
-            if t != expected:
-                assert False, f"type-error: expected `{expected}` but got `{t}`"
-        case _:
-            assert False, "unreachable"
+    kind = ty.kind
+    if kind == TY_NORMAL:
+        if ty.ty is not expected:
+            assert False, f"type-error: expected `{expected}` but got `{ty.ty}`"
+        return
+    if kind == TY_INT:
+        if not expected.mask & INT_MASK:
+            assert False, f"type-error: expected `{expected}` but got `int`"
+    elif kind == TY_FLOAT:
+        if not expected.mask & FLOAT_MASK:
+            assert False, f"type-error: expected `{expected}` but got `float`"
+    else:
+        assert False, "unreachable"
+
+    env.constraints.append((ty.node_id, expected))
 
 
 def resolve(env: Env, id: int, ty: T):
     def f(t):
         expr = env.exprs[id]
         expr.ty = t
-    match ty:
-        case Int(_):
-            f(Ty("i64"))
-        case Float(_):
-            f(Ty("f64"))
-        case Normal(): assert False
+    if ty.kind == TY_INT:
+        f(Ty("i64"))
+    elif ty.kind == TY_FLOAT:
+        f(Ty("f64"))
+    else:
+        assert False
+
+
+def dump_expr(expr: Expr) -> str:
+    # explicit stack of pending nodes and literal text, so deeply nested
+    # expressions don't hit the recursion limit
+    out: List[str] = []
+    work: List[Expr | str] = [expr]
+    while work:
+        item = work.pop()
+        if isinstance(item, str):
+            out.append(item)
+            continue
+        ty = item.ty.ty if item.ty else "?"
+        if isinstance(item, Binary):
+            work.append(f"): {ty}")
+            work.append(item.right)
+            work.append(" + ")
+            work.append(item.left)
+            work.append("(")
+        elif isinstance(item, Ident):
+            out.append(f"{item.name}: {ty}")
+        else:
+            assert isinstance(item, (IntLit, FloatLit))
+            out.append(f"{item.value}: {ty}")
+    return "".join(out)
+
+
+def dump_fn(fn: Fn) -> str:
+    lines = [f"fn {fn.name}() -> {fn.ret_ty.ty} {{"]
+    for stmt in fn.stmts:
+        if isinstance(stmt, Binding):
+            lines.append(f"    let {stmt.name} = {dump_expr(stmt.init)};")
+    if fn.last_expr:
+        lines.append(f"    {dump_expr(fn.last_expr)}")
+    lines.append("}")
+    return "\n".join(lines)
 
 
 def main():
@@ -282,17 +435,21 @@ def main():
 
     env = Env()
     infer_types(fn, env)
+    if os.environ.get("DEBUG"):
+        print(dump_fn(fn))
     # for node_id, ty in env.unresolved.items():
     #     resolve(env, node_id, ty)
 
 
 class TestInfer(unittest.TestCase):
     def _recursive_check(self, expr: Expr, ty: Ty):
-        self.assertEqual(expr.ty, ty)
-        match expr:
-            case Binary(left, right):
-                self._recursive_check(left, ty)
-                self._recursive_check(right, ty)
+        work = [expr]
+        while work:
+            expr = work.pop()
+            self.assertEqual(expr.ty, ty)
+            if isinstance(expr, Binary):
+                work.append(expr.right)
+                work.append(expr.left)
 
     def test_chained_infer(self):
         fn = Fn("test", Ty("i32"), [
@@ -375,6 +532,131 @@ class TestInfer(unittest.TestCase):
             assert isinstance(stmt, Binding)
             self._recursive_check(stmt.init, ty)
 
+    def test_deep_binary(self):
+        expr: Expr = IntLit(0)
+        for i in range(5000):
+            expr = Binary(expr, IntLit(i))
+        fn = Fn("test", Ty("i64"), [
+            Binding("a", None, expr),
+        ], Ident("a"))
+        env = Env()
+        infer_types(fn, env)
+        stmt = fn.stmts[0]
+        assert isinstance(stmt, Binding)
+        self._recursive_check(stmt.init, Ty("i64"))
+        self.assertTrue(dump_fn(fn).startswith("fn test() -> i64 {\n    let a = ((("))
+
+    def test_mismatched_literals(self):
+        fn = Fn("test", Ty("f32"), [
+            Binding("a", None, Binary(IntLit(20), FloatLit(1.5))),
+        ], Ident("a"))
+        env = Env()
+        with self.assertRaises(AssertionError):
+            infer_types(fn, env)
+
+        fn = Fn("test", Ty("f32"), [
+            Binding("a", None, IntLit(20)),
+        ], Ident("a"))
+        env = Env()
+        with self.assertRaises(AssertionError):
+            infer_types(fn, env)
+
+        fn = Fn("test", Ty("i32"), [
+            Binding("a", Ty("i32"), IntLit(1)),
+            Binding("b", Ty("i64"), IntLit(2)),
+            Binding("c", None, Binary(Ident("a"), Ident("b"))),
+        ], Ident("a"))
+        env = Env()
+        with self.assertRaises(AssertionError):
+            infer_types(fn, env)
+
+        fn = Fn("test", Ty("bool"), [
+            Binding("a", None, IntLit(20)),
+        ], Ident("a"))
+        env = Env()
+        with self.assertRaises(AssertionError):
+            infer_types(fn, env)
+
+    def test_conflicting_constraints(self):
+        fn = Fn("test", Ty("i32"), [
+            Binding("a", None, IntLit(20)),
+            Binding("b", Ty("i64"), Ident("a")),
+        ], Ident("a"))
+        env = Env()
+        with self.assertRaises(AssertionError):
+            infer_types(fn, env)
+
+    def test_interned_types(self):
+        self.assertIs(Ty("i32"), Ty("i32"))
+        self.assertIsNot(Ty("i32"), Ty("i64"))
+
+    def test_reused_env(self):
+        env = Env()
+        fn = Fn("f", Ty("i32"), [
+            Binding("a", None, IntLit(1)),
+        ], Ident("a"))
+        infer_types(fn, env)
+        assert fn.last_expr != None
+        self._recursive_check(fn.last_expr, Ty("i32"))
+
+        fn = Fn("g", Ty("i64"), [
+            Binding("x", None, IntLit(2)),
+        ], Ident("x"))
+        infer_types(fn, env)
+        assert fn.last_expr != None
+        self._recursive_check(fn.last_expr, Ty("i64"))
+
+        fn = Fn("h", Ty("i32"), [
+            Binding("y", None, IntLit(3)),
+        ], Ident("a"))
+        infer_types(fn, env)
+        assert fn.last_expr != None
+        self._recursive_check(fn.last_expr, Ty("i32"))
+        stmt = fn.stmts[0]
+        assert isinstance(stmt, Binding)
+        self.assertIsNone(stmt.init.ty)
+
+        fn = Fn("k", Ty("i64"), [
+            Binding("z", None, Binary(Ident("y"), IntLit(4))),
+        ], Ident("y"))
+        infer_types(fn, env)
+        stmt = fn.stmts[0]
+        assert isinstance(stmt, Binding)
+        self._recursive_check(stmt.init, Ty("i64"))
+        ty = env.find_ty("y")
+        assert isinstance(ty, Normal)
+        self.assertIs(ty.ty, Ty("i64"))
+
+    def test_child_scope(self):
+        parent = Env()
+        fn = Fn("f", Ty("i32"), [
+            Binding("a", None, IntLit(1)),
+        ], Ident("a"))
+        infer_types(fn, parent)
+
+        child = Env(parent)
+        fn = Fn("g", Ty("i64"), [
+            Binding("a", None, IntLit(2)),
+            Binding("b", None, Binary(Ident("a"), IntLit(3))),
+        ], Ident("b"))
+        infer_types(fn, child)
+        ty = child.find_ty("a")
+        assert isinstance(ty, Normal)
+        self.assertIs(ty.ty, Ty("i64"))
+        ty = parent.find_ty("a")
+        assert isinstance(ty, Normal)
+        self.assertIs(ty.ty, Ty("i32"))
+        self.assertIsNone(parent.find_ty("b"))
+
+        child = Env(parent)
+        fn = Fn("h", Ty("i32"), [], Ident("a"))
+        infer_types(fn, child)
+        assert fn.last_expr != None
+        self._recursive_check(fn.last_expr, Ty("i32"))
+
+        parent.add_binding("c", Normal(Ty("i32")))
+        self.assertIsNone(child.find_ty("c"))
+
 
 if __name__ == "__main__":
     main()